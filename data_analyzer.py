@@ -1,76 +1,194 @@
-import datetime as dt
-from collections import defaultdict
+import sys
 
 import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
-from dateutil.relativedelta import relativedelta
-from statsmodels.graphics.tsaplots import plot_acf, plot_pacf
-from statsmodels.stats.diagnostic import acorr_ljungbox
+from joblib import Parallel, delayed
+from numba import njit, prange
+from scipy.stats import chi2
 
-from utilities import TimeSeriesDataFrameMap, VolatilityModelsMap, FrequencyMap, min_sample_size
+from utilities import TimeSeriesDataFrameMap, VolatilityModelsMap, FrequencyMap, Panel, PanelColumn, \
+    min_sample_size, acf_lags, numba_engine_kwargs
 from models import CloseToCloseModel
 
+
+@njit(parallel=True, cache=True)
+def _sse(a, b):
+    """
+    Sum of squared errors between two arrays of the same length.
+    NaN terms are skipped, like pandas.Series.sum.
+    :param a: np.array
+    :param b: np.array
+    :return: float
+    """
+    s = 0.0
+    for i in prange(a.shape[0]):
+        d = a[i] - b[i]
+        if not np.isnan(d):
+            s += d * d
+    return s
+
+
+@njit(cache=True)
+def _residuals(data):
+    """
+    Residuals, absolute residuals and square residuals of a panel in a single pass
+    :param data: np.array
+    """
+    mean = data[:, PanelColumn.Returns].mean()
+    for i in range(data.shape[0]):
+        resid = data[i, PanelColumn.Returns] - mean
+        data[i, PanelColumn.Residuals] = resid
+        data[i, PanelColumn.Abs_residuals] = abs(resid)
+        data[i, PanelColumn.Square_residuals] = resid * resid
+
+
+@njit(cache=True)
+def _ljung_box(rho, n, h):
+    """
+    Ljung Box Q statistic up to lag h
+    :param rho: np.array
+    :param n: int
+    :param h: int
+    :return: float
+    """
+    q = 0.0
+    for k in range(1, h + 1):
+        q += rho[k] * rho[k] / (n - k)
+    return n * (n + 2) * q
+
+
+@njit(cache=True)
+def _durbin_levinson(acf, nlags):
+    """
+    Partial autocorrelation function from an autocorrelation function
+    :param acf: np.array
+    :param nlags: int
+    :return: np.array
+    """
+    pacf = np.zeros(nlags + 1)
+    pacf[0] = 1.0
+    phi, prev = np.zeros(nlags + 1), np.zeros(nlags + 1)
+    for k in range(1, nlags + 1):
+        num, den = acf[k], 1.0
+        for j in range(1, k):
+            num -= prev[j] * acf[k - j]
+            den -= prev[j] * acf[j]
+        phi[k] = num / den
+        for j in range(1, k):
+            phi[j] = prev[j] - phi[k] * prev[k - j]
+        pacf[k] = phi[k]
+        prev[:] = phi
+    return pacf
+
+
+def _plot_acf(ax, acf, n):
+    """
+    Draw a correlogram with its 95% confidence band
+    :param ax: matplotlib.axes.Axes
+    :param acf: np.array
+    :param n: int
+    """
+    ax.vlines(range(len(acf)), 0, acf)
+    ax.plot(range(len(acf)), acf, 'o')
+    ax.axhline(0)
+    ci = 1.96 / np.sqrt(n)
+    ax.axhspan(-ci, ci, alpha=0.2)
+
+
+def _fft_acf(x, nlags):
+    """
+    Autocorrelation function computed through FFT
+    :param x: np.array
+    :param nlags: int
+    :return: np.array
+    """
+    x = x - x.mean()
+    f = np.fft.rfft(x, n=2*len(x))
+    acf = np.fft.irfft(f * f.conj(), n=2*len(x))[:nlags+1]
+    return acf / acf[0]
+
+
 class DataAnalyzer:
     """
     Data analysis class.
     This class performs autocorrelation test and Ljung Box Test
     """
+    # figure shared by draw_ACFs calls
+    _fig, _axes = None, None
+
+    def __init__(self):
+        self.acfs = {}
+
     def analyze_data(self, df):
         """
         :param df: pandas.DataFrame
         """
-        self.get_residuals(df)
-        self.draw_ACFs(df)
-        self.test_autocorr(df)
+        panel = Panel(df)
+        self.get_residuals(panel)
+        self.get_ACFs(panel)
+        self.draw_ACFs(panel)
+        self.test_autocorr(panel)
 
     @staticmethod
-    def get_residuals(df):
+    def get_residuals(panel):
         """
-        :param df: pandas.DataFrame
+        :param panel: Panel
         """
-        df[TimeSeriesDataFrameMap.Residuals] = df[TimeSeriesDataFrameMap.Returns] - df[TimeSeriesDataFrameMap.Returns].mean()
-        df[TimeSeriesDataFrameMap.Abs_residuals] = df[TimeSeriesDataFrameMap.Residuals].abs()
-        df[TimeSeriesDataFrameMap.Square_residuals] = df[TimeSeriesDataFrameMap.Residuals]**2
+        _residuals(panel.data)
 
-    @staticmethod
-    def draw_ACFs(df):
+    def get_ACFs(self, panel):
         """
-        :param df: pandas.DataFrame
+        Compute autocorrelations once, they are shared by plots and tests
+        :param panel: Panel
+        """
+        for column in [PanelColumn.Residuals, PanelColumn.Abs_residuals, PanelColumn.Square_residuals]:
+            self.acfs[column] = _fft_acf(panel.column(column), acf_lags)
+
+    def draw_ACFs(self, panel):
+        """
+        :param panel: Panel
         """
         def label(ax, string):
             ax.annotate(string, (1, 1), xytext=(-8, -8), ha='right', va='top',
                         size=14, xycoords='axes fraction', textcoords='offset points')
 
-        fig, axes = plt.subplots(nrows=5, figsize=(8, 12))
-        fig.tight_layout()
+        cls = type(self)
+        if cls._fig is None or not plt.fignum_exists(cls._fig.number):
+            cls._fig, cls._axes = plt.subplots(nrows=5, figsize=(8, 12))
+            cls._fig.tight_layout()
+        else:
+            for ax in cls._axes:
+                ax.clear()
+        axes = cls._axes
+        n = len(panel)
 
-        axes[0].plot(df[TimeSeriesDataFrameMap.Square_residuals])
+        axes[0].plot(panel.to_series(PanelColumn.Square_residuals))
         label(axes[0], 'Returns')
 
-        plot_acf(df[TimeSeriesDataFrameMap.Residuals], axes[1], lags=10)
+        _plot_acf(axes[1], self.acfs[PanelColumn.Residuals], n)
         label(axes[1], 'Residuals autocorrelation')
 
-        plot_acf(df[TimeSeriesDataFrameMap.Abs_residuals], axes[2], lags=10)
+        _plot_acf(axes[2], self.acfs[PanelColumn.Abs_residuals], n)
         label(axes[2], 'Absolute residuals autocorrelation')
 
-        plot_acf(df[TimeSeriesDataFrameMap.Square_residuals], axes[3], lags=10)
+        _plot_acf(axes[3], self.acfs[PanelColumn.Square_residuals], n)
         label(axes[3], 'Square residuals autocorrelation')
 
-        plot_pacf(df[TimeSeriesDataFrameMap.Square_residuals], axes[4], lags=10)
+        _plot_acf(axes[4], _durbin_levinson(self.acfs[PanelColumn.Square_residuals], acf_lags), n)
         label(axes[4], 'Square residuals partial autocorrelation')
         plt.show()
 
-    @staticmethod
-    def test_autocorr(df):
+    def test_autocorr(self, panel):
         """
-        :param df: pandas.DataFrame
+        Ljung Box Q statistic Q = N(N+2) sum(rho_k^2 / (N-k)) on the cached autocorrelations
+        :param panel: Panel
         """
-        lbvalue, pvalue, bpvalue, bppvalue = acorr_ljungbox(df[TimeSeriesDataFrameMap.Square_residuals], lags=10, boxpierce=True)
-        print('Ljung Box Test')
-        print('Lag  P-value')
-        for l, p in zip(range(1, 13), pvalue):
-            print(l, ' ', p)
+        n = len(panel)
+        acf = self.acfs[PanelColumn.Square_residuals]
+        lines = ['Ljung Box Test', 'Lag  P-value']
+        for h in range(1, acf_lags + 1):
+            lines.append('{lag}   {pvalue}'.format(lag=h, pvalue=chi2.sf(_ljung_box(acf, n, h), h)))
+        sys.stdout.write('\n'.join(lines) + '\n')
 
 
 class ErrorEstimator:
@@ -78,31 +196,56 @@ class ErrorEstimator:
     Helper class that can help us determine the best sample size for model training.
     Calculate errors between realized volatility and estimated volatility.
     """
-    def __init__(self, model, realized_vol_estimator, frequency):
+    def __init__(self, model, realized_vol_estimator, frequency, n_jobs=-1):
         """
         :param model: VolatilityModel
         :param realized_vol_estimator: VolatilityEstimator
         :param frequency: FrequencyMap
+        :param n_jobs: int
         """
         self.model = model
         self.realized_vol_estimator = realized_vol_estimator
         self.frequency = frequency
+        self.n_jobs = n_jobs
+        # compile the error kernel before it is used in the sample size search
+        _sse(np.zeros(2), np.zeros(2))
 
-    def _get_estimated_errors(self, train_df, test_df):
+    def _get_estimated_errors(self, returns, sums, square_sums, start, split, end):
         """
-        :param train_df: pandas.DataFrame
-        :param test_df: pandas.DataFrame
+        :param returns: np.array
+        :param sums: np.array
+        :param square_sums: np.array
+        :param start: int
+        :param split: int
+        :param end: int
         :return: float
         """
-        param = self.model.train_model(train_df)
-        predictions = self.model.vol_forecast(param, len(test_df))
-        df = pd.concat([train_df, test_df])
-        cond_vols = np.concatenate((np.array(param.conditional_volatility), predictions))
-        df[TimeSeriesDataFrameMap.Cond_volatility] = pd.Series(cond_vols, index=df.index)
-        real_vol = self.realized_vol_estimator.get_realized_vol(df, len(train_df))
-        df = pd.merge(df, real_vol, left_index=True, right_index=True)
-        df[TimeSeriesDataFrameMap.Error] = (df[TimeSeriesDataFrameMap.Cond_volatility] - df[TimeSeriesDataFrameMap.Volatility])**2
-        return df[TimeSeriesDataFrameMap.Error].sum()
+        train_vals, test_vals = returns[start:split], returns[split:end]
+        param = self.model.train_model(train_vals)
+        predictions = self.model.vol_forecast(param, len(test_vals))
+        cond_vols = np.concatenate((np.asarray(param.conditional_volatility), predictions))
+        real_vol_vals = self.realized_vol_estimator.get_realized_vol_from_sums(sums, square_sums, start, end,
+                                                                               len(train_vals))
+        # realized volatility is defined from the last training point onwards,
+        # degenerate fits (alpha + beta == 1) give NaN forecasts which the sum skips
+        tail = len(test_vals) + 1
+        return _sse(np.ascontiguousarray(cond_vols[-tail:]), np.ascontiguousarray(real_vol_vals))
+
+    def _get_length_errors(self, length, returns, sums, square_sums, positions):
+        """
+        Errors of every train/test window whose training sample spans length months
+        :param length: int
+        :param returns: np.array
+        :param sums: np.array
+        :param square_sums: np.array
+        :param positions: np.array
+        :return: np.array
+        """
+        errors = np.zeros(len(positions) - 1 - length)
+        for index in range(len(errors)):
+            start, split, end = positions[index], positions[index+length], positions[index+length+1]
+            errors[index] = self._get_estimated_errors(returns, sums, square_sums, start, split, end)
+        return errors
 
     def get_best_sample_size(self, df):
         """
@@ -112,39 +255,59 @@ class ErrorEstimator:
         if len(df[TimeSeriesDataFrameMap.Returns]) <= min_sample_size:
             return len(df[TimeSeriesDataFrameMap.Returns]), 0.0
 
-        errors = defaultdict(list)
-        months = sorted(set([dt.date(d.year, d.month, 1) for d in df.index]))
-        for length in range(1, len(months)):
-            current_months = months[:-length]
-            for index, train_start in enumerate(current_months):
-                train_end = months[index+length]
-                test_start = train_end
-                test_end = test_start + relativedelta(months=1)
-                train_df, test_df = df[train_start: train_end], df[test_start: test_end]
-                errors[length].append(self._get_estimated_errors(train_df, test_df))
-        sample_size, min_error = 1, np.mean(errors[1])
-        for length, err in errors.items():
-            current_err = np.mean(err)
-            if current_err < min_error:
-                min_error = current_err
-                sample_size = length
+        months = np.unique(df.index.values.astype('datetime64[M]'))
+        if len(months) < 2:
+            return 1, np.nan
+
+        # integer boundaries of each month, last one closes the final month
+        positions = np.append(df.index.searchsorted(months.astype('datetime64[ns]')), len(df))
+        returns = df[TimeSeriesDataFrameMap.Returns].values
+        # cumulative sums let every window read its realized volatility without a rolling pass
+        sums = np.concatenate(([0.0], np.cumsum(returns)))
+        square_sums = np.concatenate(([0.0], np.cumsum(returns**2)))
+        # sample lengths are independent, large arrays are memory mapped to the workers by joblib
+        length_errors = Parallel(n_jobs=self.n_jobs, backend='loky')(
+            delayed(self._get_length_errors)(length, returns, sums, square_sums, positions)
+            for length in range(1, len(months)))
+        # errors[length, index], the only expected NaNs are the cells with index >= len(months) - length,
+        # whose windows do not exist. Window errors themselves are always finite sums.
+        errors = np.full((len(months), len(months)), np.nan)
+        for length, length_error in enumerate(length_errors, 1):
+            errors[length, :len(length_error)] = length_error
+        lengths = np.arange(1, len(months))
+        exists = np.arange(len(months)) < (len(months) - lengths)[:, np.newaxis]
+        mean_errors = np.where(exists, errors[1:], 0.0).sum(axis=1) / exists.sum(axis=1)
+        sample_size = int(np.argmin(mean_errors)) + 1
+        min_error = mean_errors[sample_size-1]
         return sample_size, min_error
 
 
+# plot title and x axis label of analyze_realized_vol for each frequency
+_documents = {
+    FrequencyMap.Minute: ('Average intraday minute realized volatility between {start_date} and {end_date}', 'Hour-Minute'),
+    FrequencyMap.Hour: ('Average intraday hourly realized volatility between {start_date} and {end_date}', 'Hour'),
+    FrequencyMap.Day: ('Average daily realized volatility between {start_date} and {end_date}', 'Day'),
+    FrequencyMap.Month: ('Average monthly realized volatility between {start_date} and {end_date}', 'Month'),
+}
+
+
 class VolatilityEstimator(object):
     """
     Volatility analysis class.
     Analyze realized volatility by using provided models and parameters.
     """
-    def __init__(self, model_type, clean, frequency):
+    def __init__(self, model_type, clean, frequency, numba=False):
         """
         :param model_type: RealizedVolModel
         :param clean: boolean
         :param frequency: int
+        :param numba: boolean
         """
         self.model_type = model_type
         self.clean = clean
         self.frequency = frequency
+        self.engine = 'numba' if numba else 'cython'
+        self.engine_kwargs = numba_engine_kwargs if numba else None
 
         if self.model_type is None or self.model_type == '':
             raise ValueError('Model type required')
@@ -167,7 +330,25 @@ class VolatilityEstimator(object):
             ))
 
         if self.model_type == VolatilityModelsMap.CloseToClose:
-            return CloseToCloseModel(df, window, self.clean).get_estimator()
+            return CloseToCloseModel(df, window, self.clean, self.engine).get_estimator()
+
+    def get_realized_vol_from_sums(self, sums, square_sums, start, end, window):
+        """
+        :param sums: np.array
+        :param square_sums: np.array
+        :param start: int
+        :param end: int
+        :param window: int
+        :return: np.array
+        """
+        if end - start <= window:
+            raise ValueError('Dataset is too small {size} compared to rolling windows {window}'.format(
+                size=end - start,
+                window=window
+            ))
+
+        if self.model_type == VolatilityModelsMap.CloseToClose:
+            return CloseToCloseModel.get_estimator_from_sums(sums, square_sums, start, end, window)
 
     def analyze_realized_vol(self, df, interested_start_date, interested_end_date, window):
         """
@@ -189,7 +370,7 @@ class VolatilityEstimator(object):
             raise ValueError('Unknown frequency {frequency}'.format(frequency=self.frequency))
 
         title, xlabel = self._get_documents()
-        agg_minute = vol.groupby(groups).mean()
+        agg_minute = vol.groupby(groups).mean(engine=self.engine, engine_kwargs=self.engine_kwargs)
         agg_plt = agg_minute[TimeSeriesDataFrameMap.Volatility].plot(
             title=title.format(
             start_date=interested_start_date,
@@ -201,13 +382,6 @@ class VolatilityEstimator(object):
 
     def _get_documents(self):
         """
-        :return: str
+        :return: tuple
         """
-        if self.frequency == '1Min':
-            return 'Average intraday minute realized volatility between {start_date} and {end_date}', 'Hour-Minute'
-        elif self.frequency == 'H':
-            return 'Average intraday hourly realized volatility between {start_date} and {end_date}', 'Hour'
-        elif self.frequency == 'D':
-            return 'Average daily realized volatility between {start_date} and {end_date}', 'Day'
-        elif self.frequency == 'M':
-            return 'Average monthly realized volatility between {start_date} and {end_date}', 'Month'
+        return _documents[self.frequency]
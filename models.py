@@ -5,9 +5,8 @@ from abc import ABCMeta, abstractmethod
 import numpy as np
 import pandas as pd
 from arch import arch_model
-from dateutil.relativedelta import relativedelta
 
-from utilities import TimeSeriesDataFrameMap, get_timestamps, min_sample_size
+from utilities import TimeSeriesDataFrameMap, get_timestamps, min_sample_size, one_month, numba_engine_kwargs
 
 
 class VolatilityModel:
@@ -81,10 +80,10 @@ class Garch11(VolatilityModel):
         :return: pandas.DataFrame
         """
 
-        months = sorted(set([dt.date(d.year, d.month, 1) for d in df.index]))[-sample_size]
+        months = np.unique(df.index.values.astype('datetime64[M]'))[-sample_size]
         start_timestamp = df.index[-1] + dt.timedelta(days=1)
         start_timestamp = dt.datetime(start_timestamp.year, start_timestamp.month, start_timestamp.day)
-        end_timestamp = start_timestamp + relativedelta(months=1)
+        end_timestamp = start_timestamp + one_month
         timestamps = list(get_timestamps(start_timestamp, end_timestamp, frequency))
         if len(df[TimeSeriesDataFrameMap.Returns]) <= min_sample_size:
             return pd.DataFrame(pd.Series.rolling(df[TimeSeriesDataFrameMap.Returns],
@@ -133,28 +132,61 @@ class CloseToCloseModel(RealizedVolModel):
     Close to open volatility is not considered.
     Usually this model underestimates volatility.
     """
-    def __init__(self, df, window, clean):
+    def __init__(self, df, window, clean, engine='cython'):
         """
         :param df: pandas.DataFrame
         :param window: int
         :param clean: boolean
+        :param engine: str
         """
         super().__init__(df, window, clean)
+        self.engine = engine
+        self.engine_kwargs = numba_engine_kwargs if engine == 'numba' else None
+
+    @staticmethod
+    def get_adjustment_factor(window, count):
+        """
+        :param window: int
+        :param count: int
+        :return: float
+        """
+        return math.sqrt((1.0 / (1.0 - (window / (count - (window - 1.0))) + (window**2 - 1.0) /
+                                 (3.0 * (count - (window - 1.0))**2))))
 
     def get_estimator(self):
         """
         :return: pandas.DataFrame
         """
-        vol = pd.Series.rolling(self.df[TimeSeriesDataFrameMap.Returns], window=self.window).std()
-        adj_factor = math.sqrt((1.0 / (1.0 - (self.window / (self.df[TimeSeriesDataFrameMap.Returns].count() - (self.window - 1.0))) + (self.window**2 - 1.0) /
-                                       (3.0 * (self.df[TimeSeriesDataFrameMap.Returns].count() - (self.window - 1.0))**2))))
-        result = vol * adj_factor
-        result[:self.window-1] = np.nan
-        result = pd.DataFrame(data=result)
-        result.columns = [TimeSeriesDataFrameMap.Volatility]
+        vol = pd.Series.rolling(self.df[TimeSeriesDataFrameMap.Returns], window=self.window).std(
+            engine=self.engine, engine_kwargs=self.engine_kwargs)
+        adj_factor = self.get_adjustment_factor(self.window, self.df[TimeSeriesDataFrameMap.Returns].count())
+        vol_vals = vol.to_numpy() * adj_factor
+        vol_vals[:self.window-1] = np.nan
+        # same length and order as the index, no alignment needed
+        result = pd.DataFrame(index=self.df.index)
+        result[TimeSeriesDataFrameMap.Volatility] = vol_vals
         if self.clean:
             return result.dropna()
         else:
             return result
 
+    @classmethod
+    def get_estimator_from_sums(cls, sums, square_sums, start, end, window):
+        """
+        Realized volatility of the rows start to end of a series, given the cumulative sums
+        of its returns and square returns. Only the defined values, from the end of the
+        first window onwards, are returned.
+        :param sums: np.array
+        :param square_sums: np.array
+        :param start: int
+        :param end: int
+        :param window: int
+        :return: np.array
+        """
+        rows = np.arange(start + window, end + 1)
+        window_sums = sums[rows] - sums[rows - window]
+        window_square_sums = square_sums[rows] - square_sums[rows - window]
+        variance = np.maximum(window_square_sums - window_sums**2 / window, 0.0) / (window - 1.0)
+        return np.sqrt(variance) * cls.get_adjustment_factor(window, end - start)
+
 
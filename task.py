@@ -51,7 +51,7 @@ class Task:
         for symbol in self.interested_symbols:
             df = self.loader.fetch(symbol, self.interested_start_date, self.interested_end_date)
             df = self.pre_process.pre_process(df)
-            self.data_analyzer.analyze_data(df.copy())
+            self.data_analyzer.analyze_data(df)
             self.estimator.analyze_realized_vol(df, self.interested_start_date, self.interested_end_date, self.analysis_window)
             sample_size, error = self.error_estimator.get_best_sample_size(df)
             predictions = self.model.get_predictions(df, sample_size, self.frequency)
@@ -1,8 +1,14 @@
 import datetime as dt
+from enum import IntEnum
 
+import numpy as np
+import pandas as pd
 from dateutil.relativedelta import relativedelta
 
 min_sample_size = 20
+acf_lags = 10
+one_month = relativedelta(months=1)
+numba_engine_kwargs = {'nopython': True, 'nogil': True, 'parallel': True}
 
 
 class TimeSeriesDataFrameMap:
@@ -18,6 +24,44 @@ class TimeSeriesDataFrameMap:
     Error = 'error'
 
 
+class PanelColumn(IntEnum):
+    Returns = 0
+    Residuals = 1
+    Abs_residuals = 2
+    Square_residuals = 3
+
+
+class Panel:
+    """
+    Numeric columns of a time series stored in a single contiguous float64 array.
+    Columns are addressed by PanelColumn, pandas objects are only built for plotting.
+    """
+    def __init__(self, df):
+        """
+        :param df: pandas.DataFrame
+        """
+        self.index = df.index
+        self.data = np.zeros((len(df), len(PanelColumn)))
+        self.data[:, PanelColumn.Returns] = df[TimeSeriesDataFrameMap.Returns].values
+
+    def __len__(self):
+        return len(self.data)
+
+    def column(self, column):
+        """
+        :param column: PanelColumn
+        :return: np.array
+        """
+        return self.data[:, column]
+
+    def to_series(self, column):
+        """
+        :param column: PanelColumn
+        :return: pandas.Series
+        """
+        return pd.Series(self.data[:, column], index=self.index, name=column.name.lower())
+
+
 class VolatilityModelsMap:
     CloseToClose = 'closetoclose'
 
@@ -44,7 +88,7 @@ def get_timestamps(start_timestamp, end_timestamp, frequency):
     elif frequency == FrequencyMap.Day:
         delta = dt.timedelta(days=1)
     elif frequency == FrequencyMap.Month:
-        delta = relativedelta(months=1)
+        delta = one_month
     else:
         raise ValueError('Unknown frequency {frequency}'.format(frequency=frequency))
 